@@ -1,38 +1,93 @@
-# import pandas
+#!/usr/bin/env python3
+# Compute tumor purity (rho) and ploidy (psi) per sample from HATCHet seg/bbc ucn files,
+# e.g. to pass as rho_manual/psi_manual to ascat.runAscat or as sample ploidy in CNAViz.
+
+import argparse
+import sys
+from multiprocessing import Pool
+
+import numpy as np
 import pandas as pd
 
-# Read remote old HATCHet result's file
-#data = pd.read_csv("https://github.com/raphael-group/hatchet-paper/raw/master/cancer/Casasent2018/P10/results/best.bbc.ucn.gz", sep='\t')
-#data = pd.read_csv('/Users/gillianchu/mek/cnaviz/og_hatchet/output_P10/results/best.bbc.ucn', sep='\t')
-data = pd.read_csv('/Users/gillianchu/mek/cnaviz/simulations/hatchet-paper/simulation/free/noWGD/dataset_n2_s4669/k4_01090_02008_00506035_00504055/hatchet/hatchet.seg.ucn.gz', sep='\t')
 
-# Compute tumor purity per every row
-data['TumorPurity'] = 1 - data['u_normal']
+NUM_PROCESSES = 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute tumor purity (rho) and sample/tumor ploidy (psi) per sample for a cohort of HATCHet seg.ucn or bbc.ucn files.')
+    parser.add_argument('input_files', nargs='+', type=str,
+                        help='HATCHet .seg.ucn/.bbc.ucn files (optionally gzipped) with `SAMPLE`, `START`, `END`, `cn_*` and `u_*` columns')
+    parser.add_argument('--output_file', '-o', nargs='?', default=None, type=str,
+                        help='Tab-separated summary table to write (default: print to stdout)')
+    parser.add_argument('--num_processes', '-p', nargs='?', default=NUM_PROCESSES, type=int,
+                        help=f'Number of processes to use for reading files (default: {NUM_PROCESSES})')
+    args = parser.parse_args()
+
+    with Pool(args.num_processes) as pool:
+        summaries = pool.map(summarize_file, args.input_files)
+    summary = pd.concat(summaries, ignore_index=True)
+
+    if args.output_file is None:
+        summary.to_csv(sys.stdout, sep='\t', index=False)
+    else:
+        summary.to_csv(args.output_file, sep='\t', index=False)
+        print(f"Wrote rho/psi for {len(summary)} samples to {args.output_file}", file=sys.stderr)
+
+
+def summarize_file(filename):
+    """
+    read one ucn file and return its per-sample purity and ploidy table
+    """
+    data = pd.read_csv(filename, sep='\t',
+                       usecols=lambda col: col in ('SAMPLE', 'START', 'END') or col[:3] == 'cn_' or col[:2] == 'u_')
+    summary = rho_psi(data)
+    summary.insert(0, 'FILE', filename)
+    return summary
+
+
+def total_copy_numbers(cn):
+    """
+    total copy number for every `a|b` string in the (rows x clones) array `cn`;
+    only the distinct strings are parsed, then broadcast back by their codes
+    """
+    codes, uniques = pd.factorize(cn.ravel())
+    if (codes < 0).any():
+        raise ValueError("Missing copy number in `cn_*` columns")
+    totals = pd.Series(uniques).str.split('|', expand=True).astype(int).sum(axis=1).to_numpy()
+    return totals[codes].reshape(cn.shape)
 
-# Compute size of genomic regions
-data['width'] = data['END'] - data['START']
 
-# Compute clones
-clones = [col.split('_')[1] for col in data.columns if 'cn_' == col[:3]]
+def rho_psi(data):
+    """
+    returns a table with, per sample:
+    rho (tumor purity, 1 - u_normal),
+    psi (sample ploidy including normal cells),
+    tumor_psi (tumor ploidy, clone proportions rescaled by purity),
+    each ploidy being the width-weighted mean of the proportion-weighted total copy numbers
+    """
+    clones = [col[3:] for col in data.columns if col[:3] == 'cn_']
+    tumor = np.array([clone != 'normal' for clone in clones])
 
-# Compute total copy numbers for every clone and weight it by related proportions, scaled or not by tumour purity
-for clone in clones:
-    data['tot_{}'.format(clone)] = data['cn_{}'.format(clone)].str.split('|', expand=True).astype(int).sum(axis=1)
-    data['weighted_{}'.format(clone)] = data['tot_{}'.format(clone)] * data['u_{}'.format(clone)]
-    if clone != 'normal':
-        data['scaled_weighted_{}'.format(clone)] = data['tot_{}'.format(clone)] * (data['u_{}'.format(clone)] / data['TumorPurity'])
+    # Compute total copy numbers for every clone and weight them by the clone proportions
+    tot = total_copy_numbers(data[[f'cn_{clone}' for clone in clones]].to_numpy())
+    u = data[[f'u_{clone}' for clone in clones]].to_numpy(dtype=float)
+    purity = 1 - data['u_normal'].to_numpy(dtype=float)
+    weighted = (tot * u).sum(axis=1)
+    scaled_weighted = (tot[:, tumor] * u[:, tumor]).sum(axis=1) / purity
 
-# Sum the weighted copy numbers
-data['weighted'] = sum(data['weighted_{}'.format(clone)] for clone in clones)
-data['scaled_weighted'] = sum(data['scaled_weighted_{}'.format(clone)] for clone in clones if clone != 'normal')
+    # Width-weighted means per sample
+    width = (data['END'] - data['START']).to_numpy(dtype=float)
+    sample_codes, samples = pd.factorize(data['SAMPLE'])
+    total_width = np.bincount(sample_codes, weights=width)
+    _, first_rows = np.unique(sample_codes, return_index=True)
 
-# Print tumor purity
-print("Using tumor purity as rho for ASCAT")
-print("tumor purity (rho):", data.groupby('SAMPLE')['TumorPurity'].first())
+    return pd.DataFrame({
+        'SAMPLE': samples,
+        'rho': purity[first_rows],
+        'psi': np.bincount(sample_codes, weights=width * weighted) / total_width,
+        'tumor_psi': np.bincount(sample_codes, weights=width * scaled_weighted) / total_width
+    })
 
-# Compute and print sample ploidy (including normal cells) per sample
-print("Using sample ploidy as psi for ASCAT")
-print("sample ploidy (psi, including normal cells):", data.groupby('SAMPLE')[['width', 'weighted']].apply(lambda sample : (sample['width'] * sample['weighted']).sum() / sample['width'].sum()))
 
-# Compute and print tumor ploidy (including normal cells) per sample
-print("tumor ploidy (psi, including normal cells):", data.groupby('SAMPLE')[['width', 'scaled_weighted']].apply(lambda sample : (sample['width'] * sample['scaled_weighted']).sum() / sample['width'].sum()))
+if __name__ == "__main__":
+    main()
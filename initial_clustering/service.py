@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+
+import asyncio
+import argparse
+import itertools
+import math
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit
+
+import numpy as np
+import pandas as pd
+import sklearn.metrics
+from aiohttp import web, WSMsgType
+
+from model import preprocessing, generate_labels, NUM_CLUSTERS_MIN, NUM_CLUSTERS_MAX, NUM_CLUSTERS_STEP, NUM_RESTARTS, SEED
+
+
+# default constants
+# the service only ever binds to the loopback interface
+HOST = "127.0.0.1"
+PORT = 8765
+LOCAL_HOSTNAMES = {"localhost", "127.0.0.1", "::1"}
+NUM_PROCESSES = os.cpu_count() or 1
+MAX_FINISHED_JOBS = 10
+DELETED_ID = -2
+
+# bbc table loaded once per worker process by `init_worker`
+_df = None
+
+
+def main():
+    # gather function arguments, set constants
+    parser = argparse.ArgumentParser(description='Run a local service that keeps a bbc file in memory and runs clustering, silhouette, centroid and segmentation computations for CNAViz on a process pool.')
+    parser.add_argument('--input_file', '-f', nargs='?', type=str,
+                        help='The filename for the tab-separated file containing the required columns.', required=True)
+    parser.add_argument('--port', '-P', nargs='?', default=PORT, type=int,
+                        help=f'Port on {HOST} to listen on (default: {PORT})')
+    parser.add_argument('--num_processes', '-p', nargs='?', default=NUM_PROCESSES, type=int,
+                        help=f'Number of processes to use in process pool (default: number of cores, {NUM_PROCESSES})')
+    args = parser.parse_args()
+
+    df = preprocessing(pd.read_csv(args.input_file, sep="\t"))
+    print(f"Successfully read input file ({len(df)} bins).")
+
+    web.run_app(create_app(df, args.input_file, args.num_processes, args.port), host=HOST, port=args.port)
+
+
+def create_app(df, input_file, num_processes, port=PORT):
+    """
+    build the aiohttp application; `df` is the preprocessed bbc table,
+    which is handed to each worker once when the pool starts
+    """
+    app = web.Application(middlewares=[localhost_only])
+    app["allowed_hosts"] = {f"{HOST}:{port}", f"localhost:{port}"}
+    app["df"] = df
+    app["input_file"] = os.path.abspath(input_file)
+    app["num_processes"] = num_processes
+    app["jobs"] = {}
+
+    app.router.add_get("/status", status)
+    app.router.add_post("/cluster", cluster)
+    app.router.add_get("/jobs/{job_id}", job_status)
+    app.router.add_delete("/jobs/{job_id}", delete_job)
+    app.router.add_get("/jobs/{job_id}/ws", job_progress)
+    app.router.add_post("/silhouette", silhouette)
+    app.router.add_post("/centroids", centroids)
+    app.router.add_post("/segmentation", segmentation)
+
+    app.on_startup.append(start_pool)
+    app.on_cleanup.append(stop_pool)
+    return app
+
+
+@web.middleware
+async def localhost_only(request, handler):
+    """
+    only answer requests addressed to this service by name (guards against DNS rebinding)
+    and sent from pages served from localhost, including websocket upgrades;
+    allow the web app, served from localhost on another port, to call the service
+    """
+    if request.host not in request.app["allowed_hosts"]:
+        raise web.HTTPForbidden(reason="Unexpected Host header")
+    origin = request.headers.get("Origin")
+    if origin is not None and not is_local_origin(origin):
+        raise web.HTTPForbidden(reason="Requests are only accepted from pages served from localhost")
+
+    if request.method == "OPTIONS":
+        response = web.Response()
+    else:
+        response = await handler(request)
+
+    if origin is not None:
+        response.headers["Access-Control-Allow-Origin"] = origin
+        response.headers["Access-Control-Allow-Methods"] = "GET, POST, DELETE, OPTIONS"
+        response.headers["Access-Control-Allow-Headers"] = "Content-Type"
+    return response
+
+
+def is_local_origin(origin):
+    """
+    whether `origin` is a page served from this machine (exact hostname match, any port)
+    """
+    try:
+        url = urlsplit(origin)
+        url.port
+    except ValueError:
+        return False
+    return url.scheme in ("http", "https") and url.hostname in LOCAL_HOSTNAMES
+
+
+async def start_pool(app):
+    app["pool"] = ProcessPoolExecutor(max_workers=app["num_processes"],
+                                      initializer=init_worker, initargs=(app["df"],))
+
+
+async def stop_pool(app):
+    for job in app["jobs"].values():
+        if not job["task"].done():
+            job["task"].cancel()
+    app["pool"].shutdown(cancel_futures=True)
+
+
+def init_worker(df):
+    """
+    keep the bbc table resident in every worker so requests only ship labels
+    """
+    global _df
+    _df = df
+
+
+async def status(request):
+    df = request.app["df"]
+    return web.json_response({
+        "input_file": request.app["input_file"],
+        "num_bins": len(df),
+        "samples": sorted(df["SAMPLE"].unique().tolist()) if "SAMPLE" in df.columns else [],
+        "num_processes": request.app["num_processes"],
+        "jobs": {job_id: job_summary(job) for job_id, job in request.app["jobs"].items()}
+    })
+
+
+async def cluster(request):
+    """
+    start a GMMHMM clustering run for a range of cluster numbers and restarts;
+    returns a job id whose progress can be polled or streamed
+    """
+    body = await read_json(request)
+    num_clusters_min = get_number(body, "num_clusters_min", NUM_CLUSTERS_MIN, int)
+    num_clusters_max = get_number(body, "num_clusters_max", NUM_CLUSTERS_MAX, int)
+    num_clusters_step = get_number(body, "num_clusters_step", NUM_CLUSTERS_STEP, int)
+    num_restarts = get_number(body, "num_restarts", NUM_RESTARTS, int)
+    seed = get_number(body, "seed", SEED, int)
+
+    if num_clusters_min < 1 or num_clusters_max < num_clusters_min or num_clusters_step < 1 or num_restarts < 1:
+        raise web.HTTPBadRequest(reason="Invalid cluster range or number of restarts")
+
+    clusters_range = range(num_clusters_min, num_clusters_max + 1, num_clusters_step)
+    restarts_range = range(num_restarts)
+
+    job_id = uuid.uuid4().hex
+    job = {
+        "state": "running",
+        "completed": 0,
+        "total": math.ceil((num_clusters_max - num_clusters_min + 1) / num_clusters_step) * num_restarts,
+        "results": None,
+        "error": None,
+        "listeners": set()
+    }
+    prune_jobs(request.app["jobs"])
+    request.app["jobs"][job_id] = job
+    job["task"] = asyncio.create_task(
+        run_clustering(request.app["pool"], job, clusters_range, restarts_range, seed))
+
+    return web.json_response({"job_id": job_id, **job_summary(job)}, status=202)
+
+
+async def job_status(request):
+    job = get_job(request)
+    response = job_summary(job)
+    if job["state"] == "done":
+        response["results"] = job["results"]
+    return web.json_response(response)
+
+
+async def delete_job(request):
+    """
+    cancel the job if it is still running and forget it
+    """
+    job = get_job(request)
+    job["task"].cancel()
+    await asyncio.wait([job["task"]])
+    del request.app["jobs"][request.match_info["job_id"]]
+    return web.json_response(job_summary(job))
+
+
+async def job_progress(request):
+    """
+    websocket streaming one message per finished model, then the final results
+    """
+    job = get_job(request)
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+
+    if job["state"] != "running":
+        await ws.send_json(final_message(job))
+        await ws.close()
+        return ws
+
+    job["listeners"].add(ws)
+    try:
+        async for msg in ws:
+            if msg.type == WSMsgType.ERROR:
+                break
+    finally:
+        job["listeners"].discard(ws)
+    return ws
+
+
+async def silhouette(request):
+    body = await read_json(request)
+    labels = get_labels(request.app["df"], body)
+    result = await run_in_pool(request.app["pool"], compute_silhouette, labels, bool(body.get("log", False)))
+    return web.json_response(result)
+
+
+async def centroids(request):
+    body = await read_json(request)
+    labels = get_labels(request.app["df"], body)
+    result = await run_in_pool(request.app["pool"], compute_centroids, labels, bool(body.get("log", False)))
+    return web.json_response(result)
+
+
+async def segmentation(request):
+    body = await read_json(request)
+    labels = get_labels(request.app["df"], body)
+    diploidbaf = get_number(body, "diploidbaf", 0.1, float)
+    try:
+        result = await run_in_pool(request.app["pool"], compute_segmentation, labels, diploidbaf)
+    except ImportError:
+        raise web.HTTPNotImplemented(reason="HATCHet must be installed to segment bins")
+    return web.json_response(result)
+
+
+async def read_json(request):
+    """
+    requiring application/json forces a CORS preflight for cross-origin browser requests
+    """
+    if request.content_type != "application/json":
+        raise web.HTTPUnsupportedMediaType(reason="Content-Type must be application/json")
+    if not request.can_read_body:
+        return {}
+    try:
+        body = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(reason="Request body must be JSON")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(reason="Request body must be a JSON object")
+    return body
+
+
+def get_number(body, key, default, convert):
+    try:
+        return convert(body.get(key, default))
+    except (TypeError, ValueError):
+        raise web.HTTPBadRequest(reason=f"`{key}` must be a number")
+
+
+def get_labels(df, body):
+    """
+    labels from the request (one per row of the loaded file, in file order),
+    falling back to the CLUSTER column of the loaded file
+    """
+    labels = body.get("labels")
+    if labels is None:
+        if "CLUSTER" not in df.columns:
+            raise web.HTTPBadRequest(reason="No labels were provided and the input file has no `CLUSTER` column")
+        return None
+    if not isinstance(labels, list):
+        raise web.HTTPBadRequest(reason="`labels` must be a list")
+    if len(labels) != len(df):
+        raise web.HTTPBadRequest(reason=f"Expected {len(df)} labels, got {len(labels)}")
+    try:
+        return [int(label) for label in labels]
+    except (TypeError, ValueError):
+        raise web.HTTPBadRequest(reason="`labels` must be integers")
+
+
+def get_job(request):
+    job = request.app["jobs"].get(request.match_info["job_id"])
+    if job is None:
+        raise web.HTTPNotFound(reason="Unknown job")
+    return job
+
+
+def prune_jobs(jobs):
+    """
+    keep only the most recent MAX_FINISHED_JOBS finished jobs (dicts keep insertion order)
+    """
+    finished = [job_id for job_id, job in jobs.items() if job["state"] != "running"]
+    for job_id in finished[:max(len(finished) - MAX_FINISHED_JOBS + 1, 0)]:
+        del jobs[job_id]
+
+
+def job_summary(job):
+    return {key: job[key] for key in ("state", "completed", "total", "error")}
+
+
+def final_message(job):
+    message = {"type": job["state"], **job_summary(job)}
+    if job["state"] == "done":
+        message["results"] = job["results"]
+    return message
+
+
+async def broadcast(job, message):
+    for ws in list(job["listeners"]):
+        try:
+            await ws.send_json(message)
+        except ConnectionResetError:
+            job["listeners"].discard(ws)
+
+
+async def run_in_pool(pool, fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+
+
+async def run_clustering(pool, job, clusters_range, restarts_range, seed):
+    """
+    fan each (num_clusters, restart) model out to the pool and report each one as it finishes;
+    results are laid out like model.py's results.json
+    """
+    results_dict = {"score": {"silhouette": {}, "likelihood": {}}, "labels": {}}
+    for num_clusters in clusters_range:
+        results_dict["score"]["silhouette"][f"{num_clusters}"] = [None for _ in restarts_range]
+        results_dict["score"]["likelihood"][f"{num_clusters}"] = [None for _ in restarts_range]
+        results_dict["labels"][f"{num_clusters}"] = [[] for _ in restarts_range]
+
+    loop = asyncio.get_running_loop()
+    futures = [loop.run_in_executor(pool, fit_model, num_clusters, restart_num, seed + i)
+               for i, (num_clusters, restart_num) in enumerate(itertools.product(clusters_range, restarts_range))]
+    try:
+        for future in asyncio.as_completed(futures):
+            (num_clusters, restart_num), (silhouette_score, likelihood_score, labels) = await future
+            results_dict["score"]["silhouette"][f"{num_clusters}"][restart_num] = silhouette_score
+            results_dict["score"]["likelihood"][f"{num_clusters}"][restart_num] = likelihood_score
+            results_dict["labels"][f"{num_clusters}"][restart_num] = labels
+            job["completed"] += 1
+            await broadcast(job, {"type": "progress", **job_summary(job),
+                                  "num_clusters": num_clusters, "restart": restart_num + 1,
+                                  "silhouette": silhouette_score, "likelihood": likelihood_score})
+        job["state"] = "done"
+        job["results"] = results_dict
+    except asyncio.CancelledError:
+        job["state"] = "cancelled"
+        raise
+    except Exception as e:
+        job["state"] = "error"
+        job["error"] = str(e)
+    finally:
+        # drop models still queued in the pool; ones already running finish and are discarded
+        for future in futures:
+            future.cancel()
+        await broadcast(job, final_message(job))
+        for ws in list(job["listeners"]):
+            await ws.close()
+
+
+def fit_model(num_clusters, restart_num, seed):
+    """
+    input: num_clusters, restart_num, seed
+    output: ((num_clusters, restart_num), (silhouette_score, likelihood_score, labels))
+    """
+    np.random.seed(seed)
+    silhouette_score, likelihood_score, labels = generate_labels(_df[["RD", "BA", "actual_start"]].copy(), num_clusters)
+    return ((num_clusters, restart_num), (nan_to_none(silhouette_score), float(likelihood_score), labels))
+
+
+def with_labels(labels):
+    """
+    the resident table with the given labels, without bins deleted in the web app
+    """
+    df = _df if labels is None else _df.assign(CLUSTER=labels)
+    return df[df["CLUSTER"] != DELETED_ID].copy()
+
+
+def rd_column(df, log):
+    return np.log2(df["RD"]) if log else df["RD"]
+
+
+def compute_silhouette(labels, log):
+    """
+    silhouette per cluster over the multi-sample (0.5 - BAF, RD) coordinates of each genomic bin,
+    mirroring reformatBins/calculatesilhouettescores in the web app but without downsampling;
+    unassigned bins (-1) form a cluster as they do there, and overall is the mean of the cluster averages
+    """
+    df = with_labels(labels)
+    df["RD_KEY"] = rd_column(df, log)
+
+    # one row per genomic bin; the cluster is taken from the first sample, as in the web app
+    index = ["#CHR", "START", "END"]
+    bins = df.pivot_table(index=index, columns="SAMPLE", values=["BA", "RD_KEY"], aggfunc="first", sort=False)
+    bins = bins.dropna()
+    bin_labels = df.groupby(index, sort=False)["CLUSTER"].first().loc[bins.index].to_numpy()
+
+    if len(np.unique(bin_labels)) < 2:
+        return {"silhouettes": [], "overall": None}
+
+    scores = sklearn.metrics.silhouette_samples(bins.to_numpy(), bin_labels)
+    per_cluster = pd.Series(scores).groupby(bin_labels).mean()
+    return {
+        "silhouettes": [{"cluster": int(c), "avg": float(s)} for c, s in per_cluster.items()],
+        "overall": float(per_cluster.mean())
+    }
+
+
+def compute_centroids(labels, log):
+    """
+    per-sample cluster centroids in (0.5 - BAF, RD) and their pairwise euclidean distances
+    """
+    df = with_labels(labels)
+    df["RD_KEY"] = rd_column(df, log)
+
+    result = {}
+    for sample, sample_df in df.groupby("SAMPLE", sort=False):
+        points = sample_df.groupby("CLUSTER")[["BA", "RD_KEY"]].mean()
+        coords = points.to_numpy()
+        dists = np.sqrt(((coords[:, None, :] - coords[None, :, :]) ** 2).sum(axis=-1))
+        clusters = points.index.astype(int).tolist()
+        result[sample] = {
+            "centroids": [{"cluster": c, "point": [float(x), float(y)]} for c, (x, y) in zip(clusters, coords)],
+            "distances": [{"cluster1": c1, "cluster2": c2, "dist": float(dists[i, j])}
+                          for i, c1 in enumerate(clusters) for j, c2 in enumerate(clusters)]
+        }
+    return result
+
+
+def compute_segmentation(labels, diploidbaf):
+    """
+    same segmentation as scripts/segment_bins.py, on the resident bbc
+    """
+    import hatchet
+    from packaging import version
+    if version.parse(hatchet.__version__) >= version.parse('1.0.1'):
+        from hatchet.utils.cluster_bins_gmm import segmentBins, scaleBAF
+    else:
+        from hatchet.utils.cluster_bins import segmentBins, scaleBAF
+
+    data = with_labels(labels)
+    combo = {}
+    for rec in data.to_dict('records'):
+        combo.setdefault((rec['#CHR'], rec['START'], rec['END']), []).append(
+            (rec['SAMPLE'], rec['RD'], rec['#SNPS'], rec['COV'], rec['ALPHA'], rec['BETA'], rec['BAF'], rec['CLUSTER']))
+    clusters = {cluster : set(key for key in combo if int(combo[key][0][-1]) == int(cluster)) for cluster in data['CLUSTER'].unique()}
+    samples = set(data['SAMPLE'].unique())
+
+    segments = segmentBins(bb=combo, clusters=clusters, samples=samples)
+    segments = scaleBAF(segments=segments, samples=samples, diploidbaf=diploidbaf)
+    columns = ["#ID", "SAMPLE", "#BINS", "RD", "#SNPS", "COV", "ALPHA", "BETA", "BAF"]
+    return [dict(zip(columns, (int(key), sample, *(to_builtin(v) for v in segments[key][sample][:7]))))
+            for key in sorted(segments) for sample in sorted(segments[key])]
+
+
+def nan_to_none(x):
+    return None if x is None or (isinstance(x, float) and math.isnan(x)) else float(x)
+
+
+def to_builtin(x):
+    return x.item() if isinstance(x, np.generic) else x
+
+
+if __name__ == "__main__":
+    main()